@@ -3,175 +3,840 @@ SageAlpha.ai – Finance Query Chatbot
 Flask backend for Azure AI Agent integration (final stable version)
 """
 
-import os, sys, logging
-from flask import Flask, request, jsonify, render_template
+import os, re, sys, time, types, uuid, queue, atexit, random, hashlib, logging, threading
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from collections.abc import Mapping
+import orjson
+from flask import (
+    Flask, Response, request, jsonify, make_response, send_from_directory, stream_with_context
+)
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from flask_caching import Cache
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from werkzeug.middleware.proxy_fix import ProxyFix
+import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+from azure.core.pipeline.transport import RequestsTransport
 from azure.identity import DefaultAzureCredential
 from azure.ai.projects import AIProjectClient
-from azure.ai.agents.models import ListSortOrder
-from waitress import serve
+from azure.ai.agents.models import (
+    ListSortOrder, MessageDeltaChunk, MessageRole, ThreadMessageOptions, ThreadRun
+)
 
 # ==========================================================
 # INITIAL SETUP
 # ==========================================================
-load_dotenv()
+# App Service / Kubernetes inject settings directly – only read .env locally
+if not os.getenv("AZURE_SUBSCRIPTION_ID"):
+    load_dotenv()
 
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s - %(levelname)s - %(message)s")
+# Every setting is read once here; the rest of the module uses CONFIG.*
+CONFIG = types.SimpleNamespace(
+    subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID"),
+    resource_group  = os.getenv("AZURE_RESOURCE_GROUP"),
+    project_name    = os.getenv("AZURE_PROJECT_NAME"),
+    endpoint        = os.getenv("AZURE_PROJECT_ENDPOINT"),
+    agent_id        = os.getenv("AZURE_AGENT_ID"),
+
+    port  = int(os.getenv("PORT", 5000)),
+    debug = os.getenv("FLASK_ENV") == "development",
+    log_format = os.getenv("LOG_FORMAT", "text"),
+
+    # Conversation threads are reused per browser session for this long (seconds)
+    thread_ttl  = int(os.getenv("THREAD_TTL", 1800)),
+    # Longest prompt accepted by /chat (characters)
+    max_msg_len = int(os.getenv("MAX_MSG_LEN", 4000)),
+
+    # Blocking agent runs are dispatched onto a shared pool, bounded by a timeout
+    agent_workers = int(os.getenv("AGENT_WORKERS", 64)),
+    run_timeout   = float(os.getenv("RUN_TIMEOUT", 120)),
+    agent_refresh_interval = int(os.getenv("AGENT_REFRESH_INTERVAL", 600)),
+
+    redis_url          = os.getenv("REDIS_URL"),
+    chat_cache_timeout = int(os.getenv("CHAT_CACHE_TIMEOUT", 3600)),
+    chat_rate_limit    = os.getenv("CHAT_RATE_LIMIT", "5/minute;1/second"),
+    # Proxies in front of the app that append to X-Forwarded-For; trusting more
+    # than really exist lets clients spoof their address past the rate limit.
+    # Direct/local: 0, App Service: 1, nginx alone: 1, nginx on App Service: 2
+    # (App Service sets WEBSITE_SITE_NAME, so its front end is counted by default)
+    proxy_hops         = int(os.getenv("PROXY_HOPS", 1 if os.getenv("WEBSITE_SITE_NAME") else 0)),
+
+    # Optional near-duplicate prompt cache (pip install -r requirements-semantic.txt)
+    semantic_cache_enabled = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true",
+    semantic_threshold     = float(os.getenv("SEMANTIC_THRESHOLD", 0.92)),
+    semantic_index_path    = os.getenv("SEMANTIC_INDEX_PATH", "semantic_cache.index")
+)
+
+
+class JSONLogFormatter(logging.Formatter):
+    """One orjson-encoded object per line (LOG_FORMAT=json)."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry).decode()
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Enqueue records as-is so formatting happens on the listener thread."""
+
+    def prepare(self, record):
+        return record
+
+
+# Request threads only enqueue; a background listener formats and writes
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(
+    JSONLogFormatter() if CONFIG.log_format == "json"
+    else logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+)
+_log_queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+log_listener = QueueListener(_log_queue_handler.queue, _log_output)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logging.basicConfig(level=logging.INFO, handlers=[_log_queue_handler])
 logger = logging.getLogger("SageAlpha")
 
+
+def _json_default(obj):
+    # Azure SDK models (e.g. run.last_error) are mappings, not dicts
+    return dict(obj) if isinstance(obj, Mapping) else str(obj)
+
+
+class ORJSONProvider(JSONProvider):
+    """jsonify() / get_json() backed by orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_json_default,
+                            option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
 
 # ==========================================================
 # ENVIRONMENT VARIABLES
 # ==========================================================
-REQUIRED = [
-    "AZURE_SUBSCRIPTION_ID",
-    "AZURE_RESOURCE_GROUP",
-    "AZURE_PROJECT_NAME",
-    "AZURE_PROJECT_ENDPOINT",
-    "AZURE_AGENT_ID"
-]
-missing = [v for v in REQUIRED if not os.getenv(v)]
+REQUIRED = {
+    "AZURE_SUBSCRIPTION_ID":  CONFIG.subscription_id,
+    "AZURE_RESOURCE_GROUP":   CONFIG.resource_group,
+    "AZURE_PROJECT_NAME":     CONFIG.project_name,
+    "AZURE_PROJECT_ENDPOINT": CONFIG.endpoint,
+    "AZURE_AGENT_ID":         CONFIG.agent_id
+}
+missing = [name for name, value in REQUIRED.items() if not value]
 if missing:
-    logger.error(f"Missing required environment variables: {', '.join(missing)}")
+    logger.error("Missing required environment variables: %s", ", ".join(missing))
     sys.exit(1)
 
-SUB_ID   = os.getenv("AZURE_SUBSCRIPTION_ID")
-RG       = os.getenv("AZURE_RESOURCE_GROUP")
-PROJ     = os.getenv("AZURE_PROJECT_NAME")
-ENDPOINT = os.getenv("AZURE_PROJECT_ENDPOINT")
-AGENT_ID = os.getenv("AZURE_AGENT_ID")
+SESSION_COOKIE = "sid"
+
+# Control characters other than tab/newline/CR are stripped from prompts
+CTRL_CHARS_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def read_chat_message():
+    """
+    Parse and validate the /chat body in one place.
+    Returns (message, None) or (None, (error text, HTTP status)).
+    """
+    try:
+        data = orjson.loads(request.get_data()) if request.data else {}
+    except orjson.JSONDecodeError:
+        return None, ("Request body must be valid JSON", 400)
+    if not isinstance(data, dict):
+        return None, ("Request body must be a JSON object", 400)
+    user_message = data.get("message") or ""
+    if not isinstance(user_message, str):
+        return None, ("Message must be a string", 400)
+    if len(user_message) > CONFIG.max_msg_len:
+        return None, (f"Message too long (>{CONFIG.max_msg_len} chars)", 413)
+    user_message = CTRL_CHARS_RE.sub("", user_message).strip()
+    if not user_message:
+        return None, ("Empty message", 400)
+    return user_message, None
+
+
+# Response cache – Redis when configured, in-process for local dev
+cache = Cache(app, config={
+    "CACHE_TYPE": "RedisCache" if CONFIG.redis_url else "SimpleCache",
+    "CACHE_REDIS_URL": CONFIG.redis_url,
+    "CACHE_DEFAULT_TIMEOUT": 300
+})
+
+# Per-client token bucket on /chat, shared across workers through Redis
+if CONFIG.proxy_hops:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=CONFIG.proxy_hops)
+elif os.getenv("WEBSITE_SITE_NAME"):
+    logger.warning("PROXY_HOPS=0 on App Service – every client shares the front end's "
+                   "address and one rate-limit bucket")
+limiter = Limiter(
+    get_remote_address,
+    app=app,
+    storage_uri=CONFIG.redis_url or "memory://",
+    # A Redis outage falls back to per-worker buckets instead of failing /chat
+    in_memory_fallback_enabled=True,
+    swallow_errors=True,
+    headers_enabled=True  # X-RateLimit-* and Retry-After
+)
+
+# ==========================================================
+# CREDENTIALS
+# ==========================================================
+TOKEN_SCOPE = "https://ai.azure.com/.default"
+TOKEN_REFRESH_MARGIN = 300  # seconds before expiry a token is re-fetched
+
+
+class CachedTokenCredential:
+    """Wrap a TokenCredential and hand out its tokens until shortly before expiry."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, claims=None, tenant_id=None, **kwargs):
+        if claims:
+            # Claims challenges (CAE) must always reach the real credential
+            return self.inner.get_token(*scopes, claims=claims, tenant_id=tenant_id, **kwargs)
+
+        key = (scopes, tenant_id)
+        token = self._tokens.get(key)
+        if token and token.expires_on - TOKEN_REFRESH_MARGIN > time.time():
+            return token
+
+        with self._lock:
+            token = self._tokens.get(key)
+            if not token or token.expires_on - TOKEN_REFRESH_MARGIN <= time.time():
+                token = self.inner.get_token(*scopes, tenant_id=tenant_id, **kwargs)
+                self._tokens[key] = token
+            return token
+
+    def reset_after_fork(self):
+        """Replace the lock, which another thread may have held when we forked."""
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.inner.close()
+
 
 # ==========================================================
 # CONNECT TO AZURE PROJECT
 # ==========================================================
+# One keep-alive pool shared by every SDK call, sized for the run pool so
+# concurrent runs never fall back to fresh TCP+TLS handshakes
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=CONFIG.agent_workers))
+
 try:
     # For local use make sure you've run:  az login
-    credential = DefaultAzureCredential()
+    credential = CachedTokenCredential(DefaultAzureCredential())
+    credential.get_token(TOKEN_SCOPE)  # pre-warm; also fails fast on bad auth
 
     project = AIProjectClient(
         credential=credential,
-        subscription_id=SUB_ID,
-        resource_group_name=RG,
-        project_name=PROJ,
-        endpoint=ENDPOINT
+        subscription_id=CONFIG.subscription_id,
+        resource_group_name=CONFIG.resource_group,
+        project_name=CONFIG.project_name,
+        endpoint=CONFIG.endpoint,
+        transport=RequestsTransport(session=SESSION, session_owner=False),
+        # azure-core's RetryPolicy: exponential backoff on 429/5xx, honours Retry-After
+        retry_total=3,
+        retry_backoff_factor=0.5
     )
 
-    logger.info(f"✓ Connected to Azure AI Project: {PROJ}")
+    logger.info("✓ Connected to Azure AI Project: %s", CONFIG.project_name)
+except Exception as e:
+    logger.error("Failed to connect to Azure AI Project: %s", e, exc_info=True)
+    sys.exit(1)
+
+# ==========================================================
+# AGENT METADATA (fetched once, refreshed in the background)
+# ==========================================================
+try:
+    AGENT_META = project.agents.get(CONFIG.agent_id)
+    logger.info("✓ Agent found: %s (%s)", AGENT_META.name, AGENT_META.id)
 except Exception as e:
-    logger.error(f"Failed to connect to Azure AI Project: {e}", exc_info=True)
+    logger.error("Agent %s not reachable – check AZURE_AGENT_ID: %s", CONFIG.agent_id, e)
     sys.exit(1)
 
+
+_refresh_started = False
+_refresh_lock = threading.Lock()
+
+
+@app.before_request
+def start_agent_refresh():
+    """
+    Start the refresh timer in the first process that serves a request, so a
+    preloading gunicorn master never runs (and forks mid-way through) it.
+    """
+    global _refresh_started
+    if not _refresh_started:
+        with _refresh_lock:
+            if not _refresh_started:
+                _refresh_started = True
+                schedule_agent_refresh()
+
+
+def refresh_agent_meta():
+    """Re-fetch agent metadata, keeping the last good copy on failure."""
+    global AGENT_META
+    try:
+        AGENT_META = project.agents.get(CONFIG.agent_id)
+    except Exception as e:
+        logger.error("Agent metadata refresh error: %s", e)
+    schedule_agent_refresh()
+
+
+def schedule_agent_refresh():
+    timer = threading.Timer(CONFIG.agent_refresh_interval, refresh_agent_meta)
+    timer.daemon = True
+    timer.start()
+
+
+# ==========================================================
+# SEMANTIC CACHE (optional)
+# ==========================================================
+semantic_cache = None
+if CONFIG.semantic_cache_enabled:
+    try:
+        from semantic_cache import SemanticCache
+        semantic_cache = SemanticCache(threshold=CONFIG.semantic_threshold,
+                                       index_path=CONFIG.semantic_index_path,
+                                       agent_id=CONFIG.agent_id)
+        atexit.register(semantic_cache.save)
+        logger.info("✓ Semantic cache enabled")
+    except Exception as e:
+        logger.error("Semantic cache disabled (see requirements-semantic.txt): %s", e)
+
+AGENT_EXECUTOR = ThreadPoolExecutor(max_workers=CONFIG.agent_workers,
+                                    thread_name_prefix="agent-run")
+
 # ==========================================================
 # ROUTES
 # ==========================================================
 @app.route("/")
 def index():
-    return render_template("index.html")
+    # Static SPA shell – nginx serves it directly when deployed behind nginx.conf
+    return send_from_directory(app.static_folder, "index.html", max_age=3600)
 
 
 @app.route("/chat", methods=["POST"])
+@limiter.limit(CONFIG.chat_rate_limit)
 def chat():
     """Handle chat messages via Azure AI Agent."""
     try:
-        data = request.get_json(force=True)
-        user_message = (data.get("message") or "").strip()
-        if not user_message:
-            return jsonify({"error": "Empty message"}), 400
-
-        logger.info(f"User message: {user_message[:80]}...")
-
-        # ---- 1️⃣ Create thread
-        thread = project.agents.threads.create()
-        logger.info(f"✓ Thread created ID: {thread.id}")
-
-        # ---- 2️⃣ Add message
-        project.agents.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=user_message
-        )
+        user_message, error = read_chat_message()
+        if error:
+            return jsonify({"error": error[0]}), error[1]
 
-        # ---- 3️⃣ Run agent
-        run = project.agents.runs.create_and_process(
-            thread_id=thread.id,
-            agent_id=AGENT_ID
-        )
-        logger.info(f"✓ Run status: {run.status}")
+        logger.info("User message: %.80s...", user_message)
 
-        if run.status == "failed":
-            return jsonify({"error": getattr(run, "last_error", "Agent failed")}), 500
+        session_id = request.cookies.get(SESSION_COOKIE) or uuid.uuid4().hex
+        stream = "text/event-stream" in request.headers.get("Accept", "")
 
-        # ---- 4️⃣ Retrieve messages
-        messages = project.agents.messages.list(
-            thread_id=thread.id,
-            order=ListSortOrder.ASCENDING
-        )
+        # ---- 1️⃣ One turn at a time per session
+        session = claim_session(session_id)
+        if session is None:
+            return jsonify({"error": "Still answering your previous message – please wait."}), 409
+        future = None
+        try:
+            # ---- 2️⃣ Identical opening prompt already answered? Later turns
+            #          depend on the conversation, so they are never cached
+            first_turn = not session.has_history
+            cache_key = chat_cache_key(user_message) if first_turn else None
+            reply = cached_reply(cache_key) if cache_key else None
+            if reply:
+                logger.info("✓ Chat cache hit")
+                future = AGENT_EXECUTOR.submit(record_turn, session, user_message, reply)
+                return chat_response(reply, session_id, stream)
 
-        # ---- 5️⃣ Extract assistant reply
-        reply = extract_assistant_response(messages)
-        if not reply:
-            reply = "I couldn’t generate a response at this time. Please try again."
+            # ---- 2️⃣b Semantically equivalent opening prompt already answered?
+            embedding = None
+            if semantic_cache and first_turn:
+                reply, embedding = semantic_cache.lookup(user_message)
+                if reply:
+                    future = AGENT_EXECUTOR.submit(record_turn, session, user_message, reply)
+                    return chat_response(reply, session_id, stream)
+
+            # ---- 3️⃣ Reuse (or create) the session's thread
+            ensure_thread(session)
+
+            # ---- 4️⃣ Post message + run agent in one streamed call on the shared pool
+            if stream:
+                deltas = queue.Queue()
+                future, led = submit_run(cache_key, session, user_message, deltas.put)
+                future.add_done_callback(lambda _: deltas.put(_STREAM_DONE))
+                if not led:  # the leader caches the shared reply
+                    cache_key = embedding = None
+                events = stream_reply(future, deltas, session, cache_key, embedding)
+                response = event_stream_response(stream_with_context(events))
+                set_session_cookie(response, session_id)
+                return response
 
-        logger.info(f"Assistant: {reply[:100]}...")
-        return jsonify({"response": reply})
+            future, led = submit_run(cache_key, session, user_message)
+            if not led:
+                cache_key = embedding = None
+        finally:
+            if future is None:  # no run took ownership of the session
+                release_session(session)
+
+        try:
+            run, reply = future.result(timeout=CONFIG.run_timeout)
+        except FutureTimeout:
+            logger.error("Agent run timed out after %ss", CONFIG.run_timeout)
+            abandon_run(session)
+            return jsonify({"error": "Agent timed out"}), 504
+
+        error, reply = finish_run(run, reply, cache_key, embedding)
+        if error:
+            return jsonify({"error": error}), 500
+        return chat_response(reply, session_id)
 
     except Exception as e:
-        logger.error(f"Chat error: {e}", exc_info=True)
+        logger.error("Chat error: %s", e, exc_info=True)
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/reset", methods=["POST"])
+def reset():
+    """Forget the session's thread and hand out a fresh session cookie."""
+    session_id = request.cookies.get(SESSION_COOKIE)
+    if session_id:
+        drop_session(session_id)
+    response = make_response(jsonify({"status": "ok"}))
+    set_session_cookie(response, uuid.uuid4().hex)
+    return response
+
+
+@app.errorhandler(429)
+def rate_limited(e):
+    logger.warning("Rate limit exceeded for %s: %s", get_remote_address(), e.description)
+    return jsonify({"error": f"Too many requests ({e.description}). Please slow down."}), 429
+
+
 @app.route("/test-agent")
 def test_agent():
-    """Check if the Azure Agent ID is valid."""
-    try:
-        agent = project.agents.get(AGENT_ID)
-        return jsonify({
-            "status": "ok",
-            "agent_name": agent.name,
-            "agent_id": agent.id
-        })
-    except Exception as e:
-        logger.error(f"Test-agent error: {e}")
-        return jsonify({"status": "error", "error": str(e)}), 500
+    """Report the Azure Agent validated at startup (refreshed in the background)."""
+    return jsonify({
+        "status": "ok",
+        "agent_name": AGENT_META.name,
+        "agent_id": AGENT_META.id
+    })
 
 
 @app.route("/health")
 def health():
-    return jsonify({"status": "healthy", "project": PROJ, "agent": AGENT_ID})
+    return jsonify({"status": "healthy", "project": CONFIG.project_name, "agent": CONFIG.agent_id})
 
 
 # ==========================================================
 # HELPER FUNCTIONS
 # ==========================================================
+class ChatSession:
+    """A browser session's Azure thread, and whether a run is active on it."""
+    __slots__ = ("thread_id", "last_used", "busy", "run_id", "has_history")
+
+    def __init__(self):
+        self.thread_id = None
+        self.last_used = time.time()
+        self.busy = False
+        self.run_id = None  # set while this session's own run is streaming
+        self.has_history = False  # replies are only shared for context-free first turns
+
+
+SESSIONS: dict[str, ChatSession] = {}
+_session_lock = threading.Lock()
+_last_sweep = 0.0
+
+
+def chat_cache_key(user_message):
+    """Exact-match cache key for a prompt sent to this agent."""
+    digest = hashlib.sha256(f"{CONFIG.agent_id}\0{user_message}".encode("utf-8")).hexdigest()
+    return f"chat:{digest}"
+
+
+def cached_reply(cache_key):
+    """Cached reply for a key, or None – a cache outage must not break /chat."""
+    try:
+        return cache.get(cache_key)
+    except Exception as e:
+        logger.error("Chat cache read error: %s", e)
+        return None
+
+
+def store_reply(cache_key, reply):
+    try:
+        cache.set(cache_key, reply, timeout=CONFIG.chat_cache_timeout)
+    except Exception as e:
+        logger.error("Chat cache write error: %s", e)
+
+
+def set_session_cookie(response, session_id):
+    response.set_cookie(SESSION_COOKIE, session_id, max_age=CONFIG.thread_ttl,
+                        httponly=True, samesite="Lax")
+
+
+def chat_response(reply, session_id, stream=False):
+    """Full reply as JSON (or a one-event stream) that (re)sets the session cookie."""
+    if stream:
+        response = event_stream_response([sse_event({"response": reply})])
+    else:
+        response = make_response(jsonify({"response": reply}))
+    set_session_cookie(response, session_id)
+    return response
+
+
+def sse_event(payload):
+    return f"data: {app.json.dumps(payload)}\n\n"
+
+
+def event_stream_response(events):
+    return Response(events, mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"  # stop nginx / App Service proxies buffering
+    })
+
+
+_STREAM_DONE = object()
+
+
+def stream_reply(future, deltas, session, cache_key, embedding):
+    """Yield SSE events: text deltas as they arrive, then the final reply."""
+    deadline = time.monotonic() + CONFIG.run_timeout
+    while True:
+        try:
+            chunk = deltas.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            logger.error("Agent run timed out after %ss", CONFIG.run_timeout)
+            abandon_run(session)
+            yield sse_event({"error": "Agent timed out"})
+            return
+        if chunk is _STREAM_DONE:
+            break
+        yield sse_event({"delta": chunk})
+
+    try:
+        run, reply = future.result()
+        error, reply = finish_run(run, reply, cache_key, embedding)
+    except Exception as e:
+        logger.error("Chat stream error: %s", e, exc_info=True)
+        error = str(e)
+    yield sse_event({"error": error} if error else {"response": reply})
+
+
+def run_completed(run):
+    """Only a completed run's reply is returned, recorded or cached."""
+    return getattr(run, "status", None) == "completed"
+
+
+def finish_run(run, reply, cache_key, embedding):
+    """Check the run outcome and cache a good first-turn reply. Returns (error, reply)."""
+    logger.info("✓ Run status: %s", getattr(run, "status", None))
+
+    if not run_completed(run):
+        # Failed, or cancelled/incomplete/expired with at most a partial reply
+        if getattr(run, "status", None) == "failed":
+            return getattr(run, "last_error", None) or "Agent failed", None
+        return "Agent run did not complete – please try again.", None
+
+    if reply:
+        if cache_key:
+            store_reply(cache_key, reply)
+        if embedding is not None:
+            semantic_cache.add(embedding, reply)
+    else:
+        reply = "I couldn’t generate a response at this time. Please try again."
+
+    logger.info("Assistant: %.100s...", reply)
+    return None, reply
+
+
+def claim_session(session_id):
+    """
+    Mark a session busy and return it, or None if a run is still active on it.
+    Azure rejects new messages on a thread with an active run, so only one
+    turn per session may be in flight.
+    """
+    global _last_sweep
+    now = time.time()
+    with _session_lock:
+        # Lazy eviction – sweep expired idle sessions at most once a minute
+        if now - _last_sweep > 60:
+            for sid, session in list(SESSIONS.items()):
+                if not session.busy and now - session.last_used > CONFIG.thread_ttl:
+                    del SESSIONS[sid]
+            _last_sweep = now
+
+        session = SESSIONS.get(session_id)
+        if session is None or (not session.busy and now - session.last_used > CONFIG.thread_ttl):
+            session = SESSIONS[session_id] = ChatSession()
+        if session.busy:
+            return None
+        session.busy = True
+        session.last_used = now
+        return session
+
+
+def release_session(session):
+    with _session_lock:
+        session.busy = False
+        session.run_id = None
+
+
+def drop_session(session_id):
+    with _session_lock:
+        SESSIONS.pop(session_id, None)
+
+
+def ensure_thread(session):
+    """Create the session's Azure thread on its first turn (session must be claimed)."""
+    if session.thread_id is None:
+        session.thread_id = project.agents.threads.create().id
+        logger.info("✓ Thread created ID: %s", session.thread_id)
+    return session.thread_id
+
+
+INFLIGHT_RUNS: dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+
+def submit_run(cache_key, session, user_message, on_delta=None):
+    """
+    Start an agent run on the pool. On a first turn (cache_key set) join a run
+    already going for the same prompt instead: an opening reply depends only
+    on the prompt, and it is then recorded in this session's own thread.
+    Later turns depend on their thread, so they always get a run of their own.
+    Only the request that starts the run receives its text deltas.
+    Returns (future, led); the claimed session is released once it's done.
+    """
+    with _inflight_lock:
+        future = INFLIGHT_RUNS.get(cache_key) if cache_key else None
+        if future is None:
+            future = AGENT_EXECUTOR.submit(run_agent, session, user_message, on_delta)
+            if cache_key:
+                INFLIGHT_RUNS[cache_key] = future
+            led = True
+        else:
+            logger.info("✓ Joined in-flight run for identical opening prompt")
+            led = False
+
+    # Registered outside the lock: callbacks run inline if already done
+    if not led:
+        future.add_done_callback(lambda f: _record_joined_run(f, session, user_message))
+        return future, led
+    if cache_key:
+        future.add_done_callback(lambda f: _release_run(cache_key, f))
+    future.add_done_callback(lambda _: release_session(session))
+    return future, led
+
+
+def _record_joined_run(future, session, user_message):
+    """Post a shared opening reply into the joining session's thread."""
+    try:
+        run, reply = future.result()
+    except Exception:
+        run, reply = None, None
+    if reply and run_completed(run):
+        AGENT_EXECUTOR.submit(record_turn, session, user_message, reply)
+    else:
+        release_session(session)
+
+
+def _release_run(cache_key, future):
+    with _inflight_lock:
+        if INFLIGHT_RUNS.get(cache_key) is future:
+            del INFLIGHT_RUNS[cache_key]
+
+
+def record_turn(session, user_message, reply):
+    """
+    Post a turn the agent didn't run for (a cached reply) into the session's
+    thread, so later turns see what the user saw. Releases the session.
+    """
+    session.has_history = True
+    try:
+        messages = [
+            ThreadMessageOptions(role=MessageRole.USER, content=user_message),
+            ThreadMessageOptions(role=MessageRole.AGENT, content=reply)
+        ]
+        if session.thread_id is None:
+            session.thread_id = project.agents.threads.create(messages=messages).id
+            logger.info("✓ Thread created ID: %s", session.thread_id)
+        else:
+            for message in messages:
+                project.agents.messages.create(thread_id=session.thread_id,
+                                               role=message.role, content=message.content)
+    except Exception as e:
+        logger.error("Could not record cached reply in thread: %s", e)
+    finally:
+        release_session(session)
+
+
+def abandon_run(session):
+    """
+    Give up on a timed-out run. The pool worker stays busy until Azure ends the
+    run, so cancel it when this session started it; a joined run is left alone.
+    """
+    run_id = session.run_id
+    if run_id is None:
+        logger.warning("Abandoned timed-out run; it keeps running until Azure finishes it")
+        return
+    try:
+        project.agents.runs.cancel(thread_id=session.thread_id, run_id=run_id)
+        logger.warning("Cancelled timed-out run %s", run_id)
+    except Exception as e:
+        logger.error("Could not cancel timed-out run %s: %s", run_id, e)
+
+
+def run_agent(session, user_message, on_delta=None):
+    """
+    Send the user message and run the agent as a single streamed call.
+
+    The message rides along as an additional message of the run, and the reply
+    is assembled from the text deltas (each also passed to on_delta), so no
+    separate messages.create / messages.list round-trip is needed.
+    Returns (last run event, reply text).
+    """
+    thread_id = session.thread_id
+    session.has_history = True
+    run, parts = None, []
+    with project.agents.runs.stream(
+        thread_id=thread_id,
+        agent_id=CONFIG.agent_id,
+        additional_messages=[
+            ThreadMessageOptions(role=MessageRole.USER, content=user_message)
+        ]
+    ) as stream:
+        for _, event_data, _ in stream:
+            if isinstance(event_data, MessageDeltaChunk):
+                parts.append(event_data.text)
+                if on_delta:
+                    on_delta(event_data.text)
+            elif isinstance(event_data, ThreadRun):
+                run = event_data
+                session.run_id = run.id
+
+    reply = "".join(parts)
+    if not reply and run_completed(run):
+        # No text deltas (e.g. non-text content) – fall back to the messages
+        # this run wrote; the reused thread also holds earlier turns' replies
+        messages = project.agents.messages.list(
+            thread_id=thread_id,
+            run_id=run.id,
+            order=ListSortOrder.DESCENDING
+        )
+        reply = extract_assistant_response(messages)
+    return run, reply
+
+
+def _extract_list(m):
+    # Format 1 (dominant): content is a list of {"type": "text", "text": {...}}
+    # items – plain dicts or SDK models, which are Mappings too
+    try:
+        for item in m.content:
+            if isinstance(item, Mapping) and item.get("type") == "text":
+                text = item.get("text") or {}
+                if isinstance(text, Mapping):
+                    return text.get("value", "")
+                return getattr(text, "value", "")
+        return None
+    except (AttributeError, TypeError):
+        return None
+
+
+def _extract_text_messages(m):
+    try:
+        text_messages = m.text_messages
+    except AttributeError:
+        return None
+    return text_messages[-1].text.value if text_messages else None
+
+
+def _extract_text_attr(m):
+    try:
+        text = m.text
+    except AttributeError:
+        return None
+    return getattr(text, "value", text) if text else None
+
+
+# Probed in order of how often each message shape shows up
+FORMAT_HANDLERS = (_extract_list, _extract_text_messages, _extract_text_attr)
+
+
 def extract_assistant_response(messages):
-    """Pull the assistant’s latest text message."""
+    """Pull the text of the newest assistant message (messages listed newest first)."""
     try:
         for m in messages:
             if m.role == "assistant":
-                if isinstance(m.content, list):
-                    for item in m.content:
-                        if isinstance(item, dict) and item.get("type") == "text":
-                            return item.get("text", {}).get("value", "")
-                if hasattr(m, "text_messages") and m.text_messages:
-                    return m.text_messages[-1].text.value
-                if hasattr(m, "text") and m.text:
-                    return getattr(m.text, "value", m.text)
+                for handler in FORMAT_HANDLERS:
+                    reply = handler(m)
+                    if reply is not None:
+                        # Sample 1% of hits to see which shapes dominate
+                        if logger.isEnabledFor(logging.DEBUG) and random.random() < 0.01:
+                            logger.debug("Reply extracted by %s", handler.__name__)
+                        return reply
+                return None
         return None
     except Exception as e:
-        logger.error(f"extract_assistant_response error: {e}")
+        logger.error("extract_assistant_response error: %s", e)
         return None
 
 
+# ==========================================================
+# FORK SAFETY (gunicorn --preload)
+# ==========================================================
+def _after_fork_in_child():
+    """
+    Everything above is built once in the gunicorn master and shared
+    copy-on-write. Sockets, locks and threads don't survive fork, so each
+    worker gets fresh ones.
+    """
+    global AGENT_EXECUTOR, _session_lock, _inflight_lock, _refresh_lock, _refresh_started
+    # The log listener thread stayed in the master – restart it on a new queue
+    _log_queue_handler.queue = log_listener.queue = queue.SimpleQueue()
+    log_listener.start()
+    SESSION.close()  # drop inherited sockets; the adapter reconnects on demand
+    credential.reset_after_fork()
+    _session_lock = threading.Lock()
+    _inflight_lock = threading.Lock()
+    INFLIGHT_RUNS.clear()
+    AGENT_EXECUTOR = ThreadPoolExecutor(max_workers=CONFIG.agent_workers,
+                                        thread_name_prefix="agent-run")
+    if semantic_cache:
+        semantic_cache.reset_after_fork()
+    # Only ever set by a serving process, but don't rely on the parent's state
+    _refresh_lock = threading.Lock()
+    _refresh_started = False
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
 # ==========================================================
 # MAIN ENTRY POINT
 # ==========================================================
 if __name__ == "__main__":
-    port = int(os.getenv("PORT", 5000))
-    debug = os.getenv("FLASK_ENV") == "development"
-    logger.info(f"🚀 SageAlpha.ai running on http://localhost:{port}")
-    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
-    serve(app, host="0.0.0.0", port=5000)
+    logger.info("🚀 SageAlpha.ai running on http://localhost:%s", CONFIG.port)
+    if CONFIG.debug:
+        app.run(host="0.0.0.0", port=CONFIG.port, debug=True, use_reloader=False)
+    else:
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=CONFIG.port, threads=CONFIG.agent_workers)
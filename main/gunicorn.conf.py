@@ -0,0 +1,26 @@
+"""
+SageAlpha.ai – Gunicorn configuration
+Loaded automatically when gunicorn is started from this folder:  gunicorn app:app
+"""
+
+import os, multiprocessing
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8000)}"
+
+# One process per core, each holding many threads that mostly wait on Azure
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 32))
+
+backlog = 2048
+keepalive = 75
+reuse_port = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 180))
+
+# Access log only while debugging – errors always go to stderr
+accesslog = "-" if os.getenv("FLASK_ENV") == "development" else None
+errorlog = "-"
+
+# Import app.py (Azure client, token cache, semantic-cache model/index) once in
+# the master; workers share it copy-on-write and reset sockets/locks after fork
+preload_app = True
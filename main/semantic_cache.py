@@ -0,0 +1,128 @@
+"""
+SageAlpha.ai – Semantic response cache
+Answers near-duplicate prompts from memory using embedding similarity
+"""
+
+import os, json, logging, threading
+
+try:
+    import fcntl  # POSIX only – saves are unlocked elsewhere (e.g. Windows dev)
+except ImportError:
+    fcntl = None
+
+import numpy as np
+import faiss
+from sentence_transformers import SentenceTransformer
+
+logger = logging.getLogger("SageAlpha")
+
+
+class SemanticCache:
+    """
+    FAISS inner-product index over L2-normalised prompt embeddings.
+    Replies belong to one agent: a saved index for another agent is ignored.
+    """
+
+    def __init__(self, model_name="sentence-transformers/all-MiniLM-L6-v2",
+                 threshold=0.92, index_path=None, agent_id=None):
+        self.model = SentenceTransformer(model_name)
+        self.threshold = threshold
+        self.index_path = index_path
+        self.agent_id = agent_id
+        self.replies = []
+        self._saved = 0  # leading entries already on disk
+        self._lock = threading.Lock()
+
+        dim = self.model.get_sentence_embedding_dimension()
+        self.index = faiss.IndexFlatIP(dim)
+        if index_path and os.path.exists(index_path):
+            self._load()
+
+    def embed(self, text):
+        """Normalised embedding for a prompt, shaped (1, dim)."""
+        vec = self.model.encode([text], normalize_embeddings=True)
+        return np.asarray(vec, dtype="float32")
+
+    def lookup(self, text):
+        """Return (cached reply or None, embedding) for a prompt."""
+        vec = self.embed(text)
+        with self._lock:
+            if self.index.ntotal == 0:
+                return None, vec
+            scores, ids = self.index.search(vec, 1)
+            score, idx = float(scores[0][0]), int(ids[0][0])
+            if idx >= 0 and score >= self.threshold:
+                logger.info("✓ Semantic cache hit (cosine %.3f)", score)
+                return self.replies[idx], vec
+        return None, vec
+
+    def add(self, vec, reply):
+        """Store a reply under a previously computed embedding."""
+        with self._lock:
+            self.index.add(vec)
+            self.replies.append(reply)
+
+    def save(self):
+        """
+        Append this process's new entries to the index and replies on disk.
+        Forked workers save at exit in turn: each merges into whatever the
+        others already wrote, under a lock file, and swaps the result in.
+        """
+        if not self.index_path:
+            return
+        with self._lock:
+            count = self.index.ntotal - self._saved
+            if count <= 0:
+                return  # nothing new – e.g. the preloading gunicorn master
+            vecs = self.index.reconstruct_n(self._saved, count)
+            replies = self.replies[self._saved:]
+            tmp = f".{os.getpid()}.tmp"
+            try:
+                with open(self.index_path + ".lock", "w") as lock:
+                    if fcntl:
+                        fcntl.flock(lock, fcntl.LOCK_EX)
+                    index, saved = self._read() or (faiss.IndexFlatIP(self.index.d), [])
+                    index.add(vecs)
+                    saved.extend(replies)
+                    faiss.write_index(index, self.index_path + tmp)
+                    with open(self.index_path + ".json" + tmp, "w", encoding="utf-8") as f:
+                        json.dump({"agent_id": self.agent_id, "replies": saved}, f)
+                    os.replace(self.index_path + tmp, self.index_path)
+                    os.replace(self.index_path + ".json" + tmp, self.index_path + ".json")
+                self._saved += count
+                logger.info("✓ Semantic cache saved (%d new, %d total)", count, index.ntotal)
+            except Exception as e:
+                logger.error("Semantic cache save error: %s", e)
+
+    def reset_after_fork(self):
+        """Give a forked worker its own lock; the model and index stay shared."""
+        self._lock = threading.Lock()
+
+    def _read(self):
+        """
+        (index, replies) from disk, or None if missing or saved for another
+        agent (which a save then overwrites); raises if unusable.
+        """
+        if not os.path.exists(self.index_path):
+            return None
+        with open(self.index_path + ".json", encoding="utf-8") as f:
+            saved = json.load(f)
+        if not isinstance(saved, dict) or saved.get("agent_id") != self.agent_id:
+            logger.warning("Semantic cache on disk belongs to another agent – discarding it")
+            return None
+        replies = saved["replies"]
+        index = faiss.read_index(self.index_path)
+        if index.ntotal != len(replies) or index.d != self.index.d:
+            raise ValueError("index and replies are out of sync")
+        return index, replies
+
+    def _load(self):
+        try:
+            loaded = self._read()
+            if loaded is None:
+                return
+            self.index, self.replies = loaded
+            self._saved = self.index.ntotal
+            logger.info("✓ Semantic cache loaded (%d entries)", self._saved)
+        except Exception as e:
+            logger.error("Semantic cache load error, starting empty: %s", e)